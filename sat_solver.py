@@ -1,24 +1,41 @@
 from dataclasses import dataclass
 from enum import Flag, auto
-from typing import List, Tuple, Optional, Union, Generator
-from itertools import combinations
+from typing import (
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+    Optional,
+    Generator,
+)
 import colorama  # type: ignore
 from time import time
 import json
+import multiprocessing
+import sys
 
-from pysat.formula import IDPool  # type: ignore
-from pysat.solvers import Minisat22  # type: ignore
+import numpy as np
+from pysat.solvers import Solver  # type: ignore
+
+
+# The first 8 colours are drawn as coloured text, the next 8 as white text on
+# a coloured background
+COLOUR_ESCAPE_SEQUENCES: Tuple[str, ...] = tuple(
+    ["\033[" + str(30 + colour) + "m" for colour in range(8)]
+    + [
+        colorama.Fore.WHITE + "\033[" + str(40 + colour) + "m"
+        for colour in range(8)
+    ]
+)
 
 
 def colour_to_escape_sequence(colour: int) -> str:
-    if colour < 8:
-        return "\033[" + str(30 + colour) + "m"
-    else:
-        return colorama.Fore.WHITE + "\033[" + str(40 + (colour - 8)) + "m"
+    return COLOUR_ESCAPE_SEQUENCES[colour]
 
 
-@dataclass(frozen=True)
-class Position:
+class Position(NamedTuple):
     row: int
     column: int
 
@@ -38,39 +55,47 @@ class FlowDirection(Flag):
     DOWN_RIGHT = DOWN | RIGHT
 
     def __str__(self) -> str:
-        return (
-            "╹"
-            if self == FlowDirection.UP
-            else "╸"
-            if self == FlowDirection.LEFT
-            else "╻"
-            if self == FlowDirection.DOWN
-            else "╺"
-            if self == FlowDirection.RIGHT
-            else "┛"
-            if self == FlowDirection.UP_LEFT
-            else "┃"
-            if self == FlowDirection.UP_DOWN
-            else "┗"
-            if self == FlowDirection.UP_RIGHT
-            else "┓"
-            if self == FlowDirection.LEFT_DOWN
-            else "━"
-            if self == FlowDirection.LEFT_RIGHT
-            else "┏"
-        )
-
-
-@dataclass(frozen=True)
-class TileFlowDirection:
-    position: Position
-    flow_direction: FlowDirection
-
-
-@dataclass(frozen=True)
-class TileColour:
-    position: Position
-    colour: int
+        return FLOW_DIRECTION_GLYPHS[self]
+
+
+FLOW_DIRECTION_GLYPHS = {
+    FlowDirection.UP: "╹",
+    FlowDirection.LEFT: "╸",
+    FlowDirection.DOWN: "╻",
+    FlowDirection.RIGHT: "╺",
+    FlowDirection.UP_LEFT: "┛",
+    FlowDirection.UP_DOWN: "┃",
+    FlowDirection.UP_RIGHT: "┗",
+    FlowDirection.LEFT_DOWN: "┓",
+    FlowDirection.LEFT_RIGHT: "━",
+    FlowDirection.DOWN_RIGHT: "┏",
+}
+
+
+# Every direction, including the combined ones (iterating a Flag only yields
+# the single-bit members on newer Python versions). A direction's index in
+# this tuple is its last coordinate in `Puzzle.flow_direction_ids`.
+FLOW_DIRECTIONS: Tuple[FlowDirection, ...] = tuple(
+    FlowDirection.__members__.values()
+)
+FLOW_DIRECTION_INDICES = {
+    flow_direction: index
+    for index, flow_direction in enumerate(FLOW_DIRECTIONS)
+}
+FLOW_DIRECTION_VALUES = np.array(
+    [flow_direction.value for flow_direction in FLOW_DIRECTIONS]
+)
+# For each single direction, a mask over `FLOW_DIRECTIONS` selecting the
+# directions that flow towards it
+FLOWS_TOWARDS: Dict[FlowDirection, np.ndarray] = {
+    direction: (FLOW_DIRECTION_VALUES & direction.value) != 0
+    for direction in (
+        FlowDirection.UP,
+        FlowDirection.LEFT,
+        FlowDirection.DOWN,
+        FlowDirection.RIGHT,
+    )
+}
 
 
 @dataclass(frozen=True)
@@ -83,20 +108,28 @@ Solution = Tuple[Tuple[Tile, ...], ...]
 
 
 def print_solution(solution: Solution) -> None:
+    # Each row is written in one go rather than tile by tile
     for row in solution:
-        for tile in row:
-            print(
-                colour_to_escape_sequence(tile.colour),
-                tile.flow_direction,
-                colorama.Style.RESET_ALL,
-                sep="",
-                end="",
+        sys.stdout.write(
+            "".join(
+                colour_to_escape_sequence(tile.colour)
+                + str(tile.flow_direction)
+                + colorama.Style.RESET_ALL
+                for tile in row
             )
-        print()
+            + "\n"
+        )
 
 
 Clause = List[int]
 
+# Names of the pysat solvers raced by `Puzzle.solve_portfolio`, from the one
+# that does best on its own
+PORTFOLIO = ("g4", "m22", "cd", "lgl")
+# Extra arguments for the pysat solvers, by name. Glucose has a mode tuned for
+# being called repeatedly on a growing formula, as `Puzzle.solve` does.
+SOLVER_OPTIONS: Dict[str, Dict[str, bool]] = {"g4": {"incr": True}}
+
 
 @dataclass
 class Puzzle:
@@ -105,8 +138,22 @@ class Puzzle:
     endpoints: Tuple[Tuple[Position, Position], ...]
 
     def __post_init__(self):
-        self.id_pool = IDPool()
         self.number_of_colours = len(self.endpoints)
+        # Variable IDs follow a fixed layout, so they are computed rather than
+        # looked up: first every tile's direction variables, then every tile's
+        # colour variables, both in row-major order.
+        number_of_tiles = self.grid_size**2
+        self.number_of_variables = number_of_tiles * (
+            len(FLOW_DIRECTIONS) + self.number_of_colours
+        )
+        self.flow_direction_ids = np.arange(
+            1, 1 + number_of_tiles * len(FLOW_DIRECTIONS), dtype=np.int32
+        ).reshape(self.grid_size, self.grid_size, len(FLOW_DIRECTIONS))
+        self.colour_ids = np.arange(
+            1 + self.flow_direction_ids.size,
+            1 + self.number_of_variables,
+            dtype=np.int32,
+        ).reshape(self.grid_size, self.grid_size, self.number_of_colours)
 
     def positions(self) -> Generator[Position, None, None]:
         for row in range(self.grid_size):
@@ -132,154 +179,195 @@ class Puzzle:
                         endpoints.append((position, position))
         return Puzzle(grid_size, tuple(endpoints))
 
-    def solve(self) -> Optional[Solution]:
-        clauses = (
-            must_not_flow_outside(self)
-            + must_have_a_direction(self)
-            + must_have_a_colour(self)
-            + must_not_have_two_directions(self)
-            + must_not_have_two_colours(self)
-            + only_endpoints_flow_one_way(self)
-            + endpoints_must_have_their_initial_colour(self)
-            + tiles_flowing_into_each_other_match(self)
+    def solve(self, solver_name: str = "g4") -> Optional[Solution]:
+        solver = Solver(
+            name=solver_name, **SOLVER_OPTIONS.get(solver_name, {})
         )
-        solver = Minisat22(bootstrap_with=clauses)
+        # Each group of clauses is handed over as soon as it is built, so
+        # only one of them is held in memory at a time.
+        for constraint in (
+            must_not_flow_outside,
+            must_have_a_direction,
+            must_have_a_colour,
+            must_not_have_two_directions,
+            must_not_have_two_colours,
+            only_endpoints_flow_one_way,
+            endpoints_must_have_their_initial_colour,
+            tiles_flowing_into_each_other_match,
+        ):
+            solver.append_formula(constraint(self))
+        # Every clause breaking a cycle is guarded by its own selector
+        # variable and only holds while that selector is assumed, so the
+        # clauses can be retracted without rebuilding the solver.
+        selectors: List[int] = []
+        # The cycle-breaking clauses added so far, so none is added twice
+        added_cycles: Set[FrozenSet[int]] = set()
         while True:
-            if not solver.solve():
+            if not solver.solve(assumptions=selectors):
                 return None
-            true_variables: List[Union[TileFlowDirection, TileColour]] = [
-                self.id_pool.obj(variable)
-                for variable in solver.get_model()
-                if variable > 0
-            ]
-            solution: List[Tuple[Tile, ...]] = []
-            for i in range(self.grid_size):
-                row: List[Tile] = []
-                for j in range(self.grid_size):
-                    tile_variables = [
-                        variable
-                        for variable in true_variables
-                        if variable.position == Position(i, j)
-                    ]
-                    flow_direction = next(
-                        variable.flow_direction
-                        for variable in tile_variables
-                        if isinstance(variable, TileFlowDirection)
-                    )
-                    colour = next(
-                        variable.colour
-                        for variable in tile_variables
-                        if isinstance(variable, TileColour)
-                    )
-                    row.append(Tile(flow_direction, colour))
-                solution.append(tuple(row))
-            cycles = find_cycles(self, tuple(solution))
+            # The model lists every variable in order, so the tile variables
+            # can be laid out like the ID tables. Each tile has exactly one
+            # direction and one colour, found by its true variable's index.
+            # Selectors come after the tile variables and are left out.
+            model = (
+                np.array(solver.get_model()[: self.number_of_variables]) > 0
+            )
+            # Each tile's direction, as an index into `FLOW_DIRECTIONS`
+            flow_directions = (
+                model[: self.flow_direction_ids.size]
+                .reshape(self.flow_direction_ids.shape)
+                .argmax(axis=-1)
+                .astype(np.int8)
+            )
+            cycles = find_cycles(self, flow_directions)
             if len(cycles) == 0:
                 break
             for clause in cycles:
-                solver.add_clause(clause)
-        return tuple(solution)
+                if frozenset(clause) in added_cycles:
+                    continue
+                added_cycles.add(frozenset(clause))
+                selector = self.number_of_variables + len(selectors) + 1
+                solver.add_clause(clause + [-selector])
+                selectors.append(selector)
+        colours = (
+            model[self.flow_direction_ids.size :]
+            .reshape(self.colour_ids.shape)
+            .argmax(axis=-1)
+        )
+        return tuple(
+            tuple(
+                Tile(FLOW_DIRECTIONS[flow_direction], colour)
+                for flow_direction, colour in zip(
+                    flow_direction_row, colour_row
+                )
+            )
+            for flow_direction_row, colour_row in zip(
+                flow_directions.tolist(), colours.tolist()
+            )
+        )
+
+    def solve_portfolio(
+        self, solver_names: Tuple[str, ...] = PORTFOLIO
+    ) -> Optional[Solution]:
+        # Each solver runs the whole search, cycle breaking included, in its
+        # own process. The first one to finish wins, and leaving the pool
+        # terminates the others. Racing more solvers than there are CPUs
+        # only slows every one of them down.
+        solver_names = solver_names[: multiprocessing.cpu_count()]
+        if len(solver_names) == 1:
+            return self.solve(solver_names[0])
+        with multiprocessing.Pool(len(solver_names)) as pool:
+            return next(pool.imap_unordered(self.solve, solver_names))
 
     def print(self) -> None:
+        # Each row is written in one go rather than tile by tile
+        endpoint_tiles = {
+            endpoint: colour_to_escape_sequence(colour)
+            + "●"
+            + colorama.Style.RESET_ALL
+            for colour, endpoint_pair in enumerate(self.endpoints)
+            for endpoint in endpoint_pair
+        }
         for row in range(self.grid_size):
-            for column in range(self.grid_size):
-                for colour, endpoint_pair in enumerate(self.endpoints):
-                    if Position(row, column) in endpoint_pair:
-                        print(
-                            colour_to_escape_sequence(colour),
-                            "●",
-                            colorama.Style.RESET_ALL,
-                            sep="",
-                            end="",
-                        )
-                        break
-                else:
-                    print(" ", end="")
-            print()
+            sys.stdout.write(
+                "".join(
+                    endpoint_tiles.get(Position(row, column), " ")
+                    for column in range(self.grid_size)
+                )
+                + "\n"
+            )
 
 
 def must_have_a_direction(puzzle: Puzzle) -> List[Clause]:
-    return [
-        [
-            puzzle.id_pool.id(TileFlowDirection(position, flow_direction))
-            for flow_direction in FlowDirection
-        ]
-        for position in puzzle.positions()
-    ]
+    # One clause per tile, listing all of its direction variables
+    return puzzle.flow_direction_ids.reshape(
+        puzzle.grid_size**2, len(FLOW_DIRECTIONS)
+    ).tolist()
 
 
 def must_have_a_colour(puzzle: Puzzle) -> List[Clause]:
-    return [
-        [
-            puzzle.id_pool.id(TileColour(position, colour))
-            for colour in range(puzzle.number_of_colours)
-        ]
-        for position in puzzle.positions()
-    ]
+    return puzzle.colour_ids.reshape(
+        puzzle.grid_size**2, puzzle.number_of_colours
+    ).tolist()
 
 
+# The at-most-one constraints below use the plain pairwise encoding on
+# purpose. A sequential counter encoding needs fewer clauses, but with at most
+# 10 directions and 16 colours per tile its auxiliary variables made the
+# solver slower on the bundled puzzles, for directions and colours alike.
 def must_not_have_two_directions(puzzle: Puzzle) -> List[Clause]:
-    return [
-        [
-            -puzzle.id_pool.id(TileFlowDirection(position, fst_direction)),
-            -puzzle.id_pool.id(TileFlowDirection(position, snd_direction)),
-        ]
-        for fst_direction, snd_direction in combinations(FlowDirection, 2)
-        for position in puzzle.positions()
-    ]
+    fst_directions, snd_directions = np.triu_indices(len(FLOW_DIRECTIONS), 1)
+    return (
+        np.stack(
+            (
+                -puzzle.flow_direction_ids[..., fst_directions],
+                -puzzle.flow_direction_ids[..., snd_directions],
+            ),
+            axis=-1,
+        )
+        .reshape(-1, 2)
+        .tolist()
+    )
 
 
 def must_not_have_two_colours(puzzle: Puzzle) -> List[Clause]:
-    return [
-        [
-            -puzzle.id_pool.id(TileColour(position, fst_colour)),
-            -puzzle.id_pool.id(TileColour(position, snd_colour)),
-        ]
-        for fst_colour, snd_colour in combinations(
-            range(puzzle.number_of_colours), 2
+    fst_colours, snd_colours = np.triu_indices(puzzle.number_of_colours, 1)
+    return (
+        np.stack(
+            (
+                -puzzle.colour_ids[..., fst_colours],
+                -puzzle.colour_ids[..., snd_colours],
+            ),
+            axis=-1,
         )
-        for position in puzzle.positions()
-    ]
+        .reshape(-1, 2)
+        .tolist()
+    )
 
 
 def must_not_flow_outside(puzzle: Puzzle) -> List[Clause]:
     clauses: List[Clause] = []
 
-    def tile_must_not_flow_outside(
-        position: Position, outside: FlowDirection
+    def tiles_must_not_flow_outside(
+        flow_direction_ids: np.ndarray, outside: FlowDirection
     ) -> None:
-        nonlocal clauses
-        clauses += [
-            [-puzzle.id_pool.id(TileFlowDirection(position, flow_direction))]
-            for flow_direction in FlowDirection
-            if flow_direction & outside
-        ]
-
-    for i in range(puzzle.grid_size):
-        tile_must_not_flow_outside(Position(row=0, column=i), FlowDirection.UP)
-        tile_must_not_flow_outside(
-            Position(row=i, column=0), FlowDirection.LEFT
-        )
-        tile_must_not_flow_outside(
-            Position(row=puzzle.grid_size - 1, column=i), FlowDirection.DOWN
-        )
-        tile_must_not_flow_outside(
-            Position(row=i, column=puzzle.grid_size - 1), FlowDirection.RIGHT
+        clauses.extend(
+            (-flow_direction_ids[..., FLOWS_TOWARDS[outside]])
+            .reshape(-1, 1)
+            .tolist()
         )
 
+    tiles_must_not_flow_outside(
+        puzzle.flow_direction_ids[0, :], FlowDirection.UP
+    )
+    tiles_must_not_flow_outside(
+        puzzle.flow_direction_ids[:, 0], FlowDirection.LEFT
+    )
+    tiles_must_not_flow_outside(
+        puzzle.flow_direction_ids[-1, :], FlowDirection.DOWN
+    )
+    tiles_must_not_flow_outside(
+        puzzle.flow_direction_ids[:, -1], FlowDirection.RIGHT
+    )
+
     return clauses
 
 
 def only_endpoints_flow_one_way(puzzle: Puzzle) -> List[Clause]:
     clauses: List[Clause] = []
-    endpoints: Tuple[Position, ...] = sum(puzzle.endpoints, tuple())
+    flow_direction_ids = puzzle.flow_direction_ids.tolist()
+    endpoints: Set[Position] = {
+        endpoint
+        for endpoint_pair in puzzle.endpoints
+        for endpoint in endpoint_pair
+    }
     for position in puzzle.positions():
         if position in endpoints:
-            clauses += [
+            clauses.append(
                 [
-                    puzzle.id_pool.id(
-                        TileFlowDirection(position, flow_direction)
-                    )
+                    flow_direction_ids[position.row][position.column][
+                        FLOW_DIRECTION_INDICES[flow_direction]
+                    ]
                     for flow_direction in (
                         FlowDirection.UP,
                         FlowDirection.LEFT,
@@ -287,13 +375,13 @@ def only_endpoints_flow_one_way(puzzle: Puzzle) -> List[Clause]:
                         FlowDirection.RIGHT,
                     )
                 ]
-            ]
+            )
         else:
-            clauses += [
+            clauses.append(
                 [
-                    puzzle.id_pool.id(
-                        TileFlowDirection(position, flow_direction)
-                    )
+                    flow_direction_ids[position.row][position.column][
+                        FLOW_DIRECTION_INDICES[flow_direction]
+                    ]
                     for flow_direction in (
                         FlowDirection.UP_LEFT,
                         FlowDirection.UP_DOWN,
@@ -303,13 +391,14 @@ def only_endpoints_flow_one_way(puzzle: Puzzle) -> List[Clause]:
                         FlowDirection.DOWN_RIGHT,
                     )
                 ]
-            ]
+            )
     return clauses
 
 
 def endpoints_must_have_their_initial_colour(puzzle: Puzzle) -> List[Clause]:
+    colour_ids = puzzle.colour_ids.tolist()
     return [
-        [puzzle.id_pool.id(TileColour(endpoint, colour))]
+        [colour_ids[endpoint.row][endpoint.column][colour]]
         for colour, endpoint_pair in enumerate(puzzle.endpoints)
         for endpoint in endpoint_pair
     ]
@@ -317,146 +406,128 @@ def endpoints_must_have_their_initial_colour(puzzle: Puzzle) -> List[Clause]:
 
 def tiles_flowing_into_each_other_match(puzzle: Puzzle) -> List[Clause]:
     clauses: List[Clause] = []
+    # The whole grid is handled at once: `tiles` and `neighbours` select the
+    # tiles on either side of every edge between two rows or columns.
+    GridSlice = Tuple[slice, slice]
 
-    def neighbour_matches(
-        position: Position,
+    def edges_match(
+        tiles: GridSlice,
         match_flow: FlowDirection,
-        neighbour_position: Position,
+        neighbours: GridSlice,
         neighbour_match_flow: FlowDirection,
     ) -> None:
-        nonlocal clauses
-        for flow_direction in FlowDirection:
-            if flow_direction & match_flow:
-                # The position flowing in the specified direction implies that
-                # the neighbour has a matching direction.
-                clauses += [
-                    [
-                        -puzzle.id_pool.id(
-                            TileFlowDirection(position, flow_direction)
-                        )
-                    ]
-                    + [
-                        puzzle.id_pool.id(
-                            TileFlowDirection(
-                                neighbour_position,
-                                neighbour_flow_direction,
-                            )
-                        )
-                        for neighbour_flow_direction in FlowDirection
-                        if neighbour_flow_direction & neighbour_match_flow
-                    ]
-                ]
-                # The position flowing in the specified direction implies that
-                # the colour of the current position determines the colour of
-                # the neighbour.
-                clauses += [
-                    [
-                        -puzzle.id_pool.id(
-                            TileFlowDirection(
-                                position,
-                                flow_direction,
-                            )
-                        ),
-                        -puzzle.id_pool.id(
-                            TileColour(
-                                position,
-                                colour,
-                            )
-                        ),
-                        puzzle.id_pool.id(
-                            TileColour(
-                                neighbour_position,
-                                colour,
-                            )
+        # The directions crossing the edges from either side, each used once
+        # for the tiles flowing across and once for the tiles they flow into
+        sides = (
+            (
+                puzzle.flow_direction_ids[tiles][
+                    ..., FLOWS_TOWARDS[match_flow]
+                ],
+                puzzle.colour_ids[tiles],
+            ),
+            (
+                puzzle.flow_direction_ids[neighbours][
+                    ..., FLOWS_TOWARDS[neighbour_match_flow]
+                ],
+                puzzle.colour_ids[neighbours],
+            ),
+        )
+        for (crossing_ids, colour_ids), (
+            neighbour_crossing_ids,
+            neighbour_colour_ids,
+        ) in (sides, sides[::-1]):
+            for index in range(crossing_ids.shape[-1]):
+                flowing = -crossing_ids[..., index, np.newaxis]
+                # The position flowing in the specified direction implies
+                # that the neighbour has a matching direction.
+                clauses.extend(
+                    np.concatenate((flowing, neighbour_crossing_ids), axis=-1)
+                    .reshape(-1, 1 + neighbour_crossing_ids.shape[-1])
+                    .tolist()
+                )
+                # The position flowing in the specified direction implies
+                # that the colour of the current position determines the
+                # colour of the neighbour.
+                clauses.extend(
+                    np.stack(
+                        np.broadcast_arrays(
+                            flowing, -colour_ids, neighbour_colour_ids
                         ),
-                    ]
-                    for colour in range(puzzle.number_of_colours)
-                ]
-
-    for position in puzzle.positions():
-        if position.row > 0:
-            neighbour_position = Position(position.row - 1, position.column)
-            neighbour_matches(
-                position,
-                FlowDirection.UP,
-                neighbour_position,
-                FlowDirection.DOWN,
-            )
-        if position.column > 0:
-            neighbour_position = Position(position.row, position.column - 1)
-            neighbour_matches(
-                position,
-                FlowDirection.LEFT,
-                neighbour_position,
-                FlowDirection.RIGHT,
-            )
-        if position.row < puzzle.grid_size - 1:
-            neighbour_position = Position(position.row + 1, position.column)
-            neighbour_matches(
-                position,
-                FlowDirection.DOWN,
-                neighbour_position,
-                FlowDirection.UP,
-            )
-        if position.column < puzzle.grid_size - 1:
-            neighbour_position = Position(position.row, position.column + 1)
-            neighbour_matches(
-                position,
-                FlowDirection.RIGHT,
-                neighbour_position,
-                FlowDirection.LEFT,
-            )
+                        axis=-1,
+                    )
+                    .reshape(-1, 3)
+                    .tolist()
+                )
+
+    all_but_first = slice(1, None)
+    all_but_last = slice(None, -1)
+    every = slice(None)
+    # Edges between rows
+    edges_match(
+        (all_but_last, every),
+        FlowDirection.DOWN,
+        (all_but_first, every),
+        FlowDirection.UP,
+    )
+    # Edges between columns
+    edges_match(
+        (every, all_but_last),
+        FlowDirection.RIGHT,
+        (every, all_but_first),
+        FlowDirection.LEFT,
+    )
     return clauses
 
 
-def find_cycles(puzzle: Puzzle, solution: Solution) -> List[Clause]:
-    def component(
-        position: Position, visited_previously: List[Position] = []
-    ) -> List[Position]:
-        if any(map(lambda previous: previous == position, visited_previously)):
-            return visited_previously
-        flow_direction = solution[position.row][position.column].flow_direction
-        visited = visited_previously + [position]
-        next_position: Optional[Position] = None
-        for direction, potential_next_position in (
-            (FlowDirection.UP, Position(position.row - 1, position.column)),
-            (FlowDirection.LEFT, Position(position.row, position.column - 1)),
-            (FlowDirection.DOWN, Position(position.row + 1, position.column)),
-            (FlowDirection.RIGHT, Position(position.row, position.column + 1)),
-        ):
-            if (
-                flow_direction & direction
-                and potential_next_position not in visited
+def find_cycles(puzzle: Puzzle, flow_directions: np.ndarray) -> List[Clause]:
+    # `flow_directions` holds each tile's index into `FLOW_DIRECTIONS`; the
+    # walk below follows the bits of the directions themselves.
+    flow_direction_values = FLOW_DIRECTION_VALUES.astype(np.int8)[
+        flow_directions
+    ]
+    visited = np.zeros((puzzle.grid_size, puzzle.grid_size), dtype=bool)
+
+    def component(position: Position) -> List[Position]:
+        row, column = position.row, position.column
+        tiles: List[Position] = []
+        while not visited[row, column]:
+            visited[row, column] = True
+            tiles.append(Position(row, column))
+            # Follow the flow to the neighbour that has not been visited yet
+            for direction, row_step, column_step in (
+                (FlowDirection.UP, -1, 0),
+                (FlowDirection.LEFT, 0, -1),
+                (FlowDirection.DOWN, 1, 0),
+                (FlowDirection.RIGHT, 0, 1),
             ):
-                next_position = potential_next_position
-                break
-        return (
-            visited + component(next_position, visited)
-            if next_position is not None
-            else visited
-        )
+                if (
+                    flow_direction_values[row, column] & direction.value
+                    and not visited[row + row_step, column + column_step]
+                ):
+                    row, column = row + row_step, column + column_step
+                    break
+        return tiles
 
-    visited: List[Position] = []
     for start, _ in puzzle.endpoints:
-        visited.extend(component(start))
-    cycles: List[List[TileFlowDirection]] = []
-    for row in range(puzzle.grid_size):
-        for column in range(puzzle.grid_size):
-            position = Position(row, column)
-            if position in visited:
-                continue
-            cycle = component(position)
-            visited.extend(cycle)
-            cycles.append(
-                [
-                    TileFlowDirection(
-                        position,
-                        solution[position.row][position.column].flow_direction,
-                    )
-                    for position in cycle
+        component(start)
+    # Without cycles the paths between the endpoints cover the whole grid
+    if visited.all():
+        return []
+    cycles: List[List[Position]] = []
+    for position in puzzle.positions():
+        if not visited[position.row, position.column]:
+            cycles.append(component(position))
+    clauses: List[Clause] = []
+    for cycle in cycles:
+        rows, columns = np.array(cycle).T
+        clauses.append(
+            (
+                -puzzle.flow_direction_ids[
+                    rows, columns, flow_directions[rows, columns]
                 ]
-            )
-    return [[-puzzle.id_pool.id(tile) for tile in cycle] for cycle in cycles]
+            ).tolist()
+        )
+    return clauses
 
 
 if __name__ == "__main__":
@@ -467,7 +538,7 @@ if __name__ == "__main__":
     puzzle.print()
     print("Solution:")
     start_time = time()
-    solution = puzzle.solve()
+    solution = puzzle.solve_portfolio()
     print(f"Finished in {time() - start_time} seconds")
     if solution is None:
         print("No solution")